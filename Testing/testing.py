@@ -5,8 +5,8 @@ from rapidfuzz import fuzz, process
 
 def read_file(path: str) -> list[str]:
     # t2 = perf_counter_ns()
-    with open(path) as file:  # , encoding='utf-8'
-        strings = file.readlines()
+    with open(path, encoding='utf-8', buffering=1 << 20) as file:
+        strings = file.read().splitlines()
     # print(f"Read file to list took: {round((perf_counter_ns() - t2) / 1e6)} ms")
     return strings
 
@@ -14,11 +14,12 @@ def read_file(path: str) -> list[str]:
 def read_file_todict(path: str) -> dict:
     # quick and dirty creating a dict with references and relations
     # t2 = perf_counter_ns()
-    with open(path) as file:  # , encoding='utf-8'
+    with open(path, encoding='utf-8', buffering=1 << 20) as file:
         rrdict = {}
-        for line in file.readlines():
-            ref_rel = line.split('*')
-            rrdict[ref_rel[0]] = ref_rel[1].strip()
+        for line in file.read().splitlines():
+            ref, sep, rel = line.partition('*')
+            if sep:
+                rrdict[ref] = rel.strip()
     # print(f"Read file to dict took: {round((perf_counter_ns() - t2) / 1e6)} ms")
     return rrdict
 
@@ -6,7 +6,7 @@ options can be applied per collection. Run queries against combinations of colle
 top n matches with their respective: collection-name, pre- and post-processing string, related value (if provided)
 and ratio of the match.
 
-Requires the RapidFuzz package.
+Requires the RapidFuzz and NumPy packages.
 
 Basic usage with default settings:
     import fuzzy_matching as fm
@@ -27,23 +27,35 @@ Compares a 6 character string to 60.000+ strings in about 15ms.
 
 
 from unicodedata import normalize
+from heapq import heappush, heapreplace
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import repeat
 from time import perf_counter_ns
 from rapidfuzz import fuzz, process
+import numpy as np
+
+
+# number of get_top results a library remembers for repeated queries
+_CACHE_SIZE = 512
+# smallest string set worth spreading over all cores, below it starting the threads costs more than it saves
+_PARALLEL_MIN = 5_000
 
 
 class StringLib:
     """ String Library
     Manage collections of strings and run fuzzy/approximate queries against them.
     """
-    __slots__ = '__strlib'
+    __slots__ = '__strlib', '__cache'
 
     def __init__(self):
         self.__strlib = {'collections': [], 'total_strings': 0}
+        self.__cache = OrderedDict()
 
     def __str__(self):
         total_refs = 0
         for collection in self.collections():
-            total_refs += self.__strlib[collection]['num_ref']
+            total_refs += self.__strlib[collection].num_ref
         return f"String Library holding {total_refs} references in {len(self.collections())} collections"
 
     def add_col(self, collection: list[str] | dict, label: str,
@@ -80,64 +92,70 @@ class StringLib:
         if len(collection) > 1:
             if type(collection) is list:
                 islist = True
-                for item in collection:
-                    if not isinstance(item, str):
-                        raise TypeError(f"'collection' list contains a non-string item: {item}")
+                # collect the item types in one pass in C, only walk the items to find an offending one
+                if not {str}.issuperset(map(type, collection)):
+                    for item in collection:
+                        if not isinstance(item, str):
+                            raise TypeError(f"'collection' list contains a non-string item: {item}")
         else:
             raise Exception(f"'collection' list or dictionary contains less than 2 items.")
 
+        self.__cache.clear()
         self.__strlib['collections'].append(label)
-        self.__strlib[label] = {}
-        self.__strlib[label]['ignore_case'] = ignore_case
-        self.__strlib[label]['to_ascii'] = to_ascii
-        self.__strlib[label]['no_strip'] = no_strip
+        self.__strlib[label] = _Collection(ignore_case, to_ascii, no_strip)
 
         # Create and store base collection and values
         if islist:
             pre_col = collection.copy()
         else:
             pre_col = list(collection.keys())
-        self.__strlib[label]['collection'] = pre_col
+        self.__strlib[label].collection = pre_col
 
-        len_col = len(pre_col)
-        self.__strlib[label]['num_ref'] = len_col
+        self.__strlib[label].num_ref = len(pre_col)
 
+        # a list shares one empty relation for all its strings, so only a dict stores values
         if islist:
-            values = [''] * len_col
+            values = None
         else:
             values = list(collection.values())
-        self.__strlib[label]['values'] = values
-
-        # creates potential misalignments
-        # while "" in pre_col:
-        #     pre_col.remove("")
-        # while "\n" in pre_col:
-        #     pre_col.remove("\n")
+        self.__strlib[label].values = values
 
         # Pre-processing
         if not no_strip:
-            pre_col = [item.strip() for item in pre_col]
+            pre_col = list(map(str.strip, pre_col))
 
+        # NFKD leaves pure ASCII strings untouched, so only the others are normalized
+        references = pre_col
         if to_ascii:
-            if ignore_case:
-                references = [normalize("NFKD", item).encode("ascii", "ignore").decode().lower() for item in pre_col]
-            else:
-                references = [normalize("NFKD", item).encode("ascii", "ignore").decode() for item in pre_col]
+            references = [item if item.isascii()
+                          else normalize("NFKD", item).encode("ascii", "ignore").decode() for item in references]
+        if ignore_case:
+            references = _lower(references)
+
+        # Group everything by length, each length holding a (references, strings, values) set of parallel lists
+        # (values being None for a list)
+        buckets = {}
+        # empty references form a length 0 set that lmin always keeps out of queries, so there is no need to filter
+        # them out first (which would also misalign references with their strings and values)
+        if islist:
+            for ref, pre in zip(references, pre_col):
+                bucket = buckets.get(len(ref))
+                if bucket is None:
+                    bucket = buckets[len(ref)] = ([], [], None)
+                bucket[0].append(ref)
+                bucket[1].append(pre)
         else:
-            if ignore_case:
-                references = [item.lower() for item in pre_col]
-            else:
-                references = pre_col.copy()
-
-        # Create dicts with everything grouped by length
-        self.__strlib[label]['col_by_len'] = {}
-        self.__strlib[label]['ref_by_len'] = {}
-        self.__strlib[label]['val_by_len'] = {}
-        for i, ref in enumerate(references):
-            length = len(ref)
-            self.__strlib[label]['col_by_len'].setdefault(length, []).append(pre_col[i])
-            self.__strlib[label]['ref_by_len'].setdefault(length, []).append(ref)
-            self.__strlib[label]['val_by_len'].setdefault(length, []).append(values[i])
+            for ref, pre, value in zip(references, pre_col, values):
+                bucket = buckets.get(len(ref))
+                if bucket is None:
+                    bucket = buckets[len(ref)] = ([], [], [])
+                bucket[0].append(ref)
+                bucket[1].append(pre)
+                bucket[2].append(value)
+        self.__strlib[label].buckets = buckets
+        self.__strlib[label].lengths = sorted(buckets)
+        # the order in which lengths first appear, which decides between equal ratios from different string sets
+        self.__strlib[label].ranks = {length: rank for rank, length in enumerate(buckets)}
 
     def del_col(self, label: str):
         """ Delete a collection from this library
@@ -145,6 +163,7 @@ class StringLib:
         """
         if type(label) is not str:
             raise TypeError(f"'label' argument is not a string: {label}")
+        self.__cache.clear()
         self.__strlib.pop(label, None)
         self.__strlib['collections'].remove(label)
 
@@ -157,6 +176,7 @@ class StringLib:
             raise TypeError(f"'old_label' argument is not a string: {old_label}")
         if type(new_label) is not str:
             raise TypeError(f"'new_label' argument is not a string: {new_label}")
+        self.__cache.clear()
         try:
             self.__strlib[new_label] = self.__strlib.pop(old_label)
             self.__strlib['collections'].remove(old_label)
@@ -182,26 +202,47 @@ class StringLib:
         if label not in self.__strlib:
             raise KeyError(f"Collection not found: {label}")
         if ignore_case is None:
-            ignore_case = self.__strlib[label]['ignore_case']
+            ignore_case = self.__strlib[label].ignore_case
         else:
             if type(ignore_case) is not bool:
                 raise TypeError(f"'ignore_case' argument is not a boolean: {ignore_case}")
         if to_ascii is None:
-            to_ascii = self.__strlib[label]['to_ascii']
+            to_ascii = self.__strlib[label].to_ascii
         else:
             if type(to_ascii) is not bool:
                 raise TypeError(f"'to_ascii' argument is not a boolean: {to_ascii}")
         if no_strip is None:
-            no_strip = self.__strlib[label]['no_strip']
+            no_strip = self.__strlib[label].no_strip
         else:
             if type(no_strip) is not bool:
                 raise TypeError(f"'no_strip' argument is not a boolean: {no_strip}")
 
-        if self.__strlib[label]['ignore_case'] == ignore_case and self.__strlib[label]['to_ascii'] == to_ascii \
-                and self.__strlib[label]['no_strip'] == no_strip:
+        if self.__strlib[label].ignore_case == ignore_case and self.__strlib[label].to_ascii == to_ascii \
+                and self.__strlib[label].no_strip == no_strip:
             return
 
-        temp_col = dict(zip(self.__strlib[label]['collection'], self.__strlib[label]['values']))
+        # switching ignore_case on lowers the stored references in place if no string changes length
+        col = self.__strlib[label]
+        if ignore_case and not col.ignore_case and col.to_ascii == to_ascii and col.no_strip == no_strip:
+            buckets = {}
+            for length, (ref_list, pre_list, val_list) in col.buckets.items():
+                low_list = _lower(ref_list)
+                if not {length}.issuperset(map(len, low_list)):
+                    break
+                buckets[length] = (low_list, pre_list, val_list)
+            else:
+                self.__cache.clear()
+                col.ignore_case = True
+                col.buckets = buckets
+                # move to the end like a re-added collection
+                self.__strlib['collections'].remove(label)
+                self.__strlib['collections'].append(label)
+                return
+
+        if self.__strlib[label].values is None:
+            temp_col = self.__strlib[label].collection
+        else:
+            temp_col = dict(zip(self.__strlib[label].collection, self.__strlib[label].values))
 
         self.del_col(label)
         self.add_col(temp_col, label, ignore_case=ignore_case, to_ascii=to_ascii, no_strip=no_strip)
@@ -221,15 +262,14 @@ class StringLib:
             raise KeyError(f"Collection not found: {label}")
 
         info = {'label': label,
-                'ignore_case': self.__strlib[label]['ignore_case'],
-                'to_ascii': self.__strlib[label]['to_ascii'],
-                'no_strip': self.__strlib[label]['no_strip'],
-                'num_strings': self.__strlib[label]['num_ref']}
+                'ignore_case': self.__strlib[label].ignore_case,
+                'to_ascii': self.__strlib[label].to_ascii,
+                'no_strip': self.__strlib[label].no_strip,
+                'num_strings': self.__strlib[label].num_ref}
         if full:
             collection = []
-            for length, value in self.__strlib[label]['col_by_len'].items():
-                for i, pre_col in enumerate(value):
-                    collection.append((pre_col, self.__strlib[label]['ref_by_len'][length][i], self.__strlib[label]['val_by_len'][length][i]),)
+            for references, pre_col, values in self.__strlib[label].buckets.values():
+                collection.extend(zip(pre_col, references, values if values is not None else repeat('')))
             info['collection'] = collection
         return info
 
@@ -243,6 +283,7 @@ class StringLib:
         """ Clear this library
         """
         self.__strlib = {'collections': [], 'total_strings': 0}
+        self.__cache.clear()
 
     def lib_info(self) -> dict:
         """ Get information about this library
@@ -252,12 +293,12 @@ class StringLib:
         info = {'collections': collections}
         tot_refs = 0
         for collection in collections:
-            tot_refs += self.__strlib[collection]['num_ref']
+            tot_refs += self.__strlib[collection].num_ref
             info[collection] = {}
-            info[collection]['num_strings'] = self.__strlib[collection]['num_ref']
-            info[collection]['ignore_case'] = self.__strlib[collection]['ignore_case']
-            info[collection]['to_ascii'] = self.__strlib[collection]['to_ascii']
-            info[collection]['no_strip'] = self.__strlib[collection]['no_strip']
+            info[collection]['num_strings'] = self.__strlib[collection].num_ref
+            info[collection]['ignore_case'] = self.__strlib[collection].ignore_case
+            info[collection]['to_ascii'] = self.__strlib[collection].to_ascii
+            info[collection]['no_strip'] = self.__strlib[collection].no_strip
         info['total_strings'] = tot_refs
         return info
 
@@ -279,10 +320,12 @@ class StringLib:
         :return: A dictionary with results and some stats about the search.
         """
         # LBYL checks
-        if query.strip() == "" or query is None:
+        if query is None:
             return None
         if type(query) is not str:
             raise TypeError(f"'query' argument is not a string: {query}")
+        if not query or query.isspace():
+            return None
         if collections:
             if type(collections) is not list:
                 raise TypeError(f"'collections' argument is not a list: {collections}")
@@ -312,59 +355,165 @@ class StringLib:
 
         if top == 0:
             top = None
-        results = {'query': query, 'skipped': 0, 'total': 0}
         st_t0 = perf_counter_ns()
 
+        # answer repeated queries from the cache, which any change to the library clears
+        # (returning copies so callers can't alter what is cached)
+        cache_key = (query, tuple(collections), top, look_around, lmin, lmax)
+        if cache_key in self.__cache:
+            self.__cache.move_to_end(cache_key)
+            results = self.__cache[cache_key].copy()
+            results['results'] = results['results'].copy()
+            results['collections'] = results['collections'].copy()
+            results['time'] = round((perf_counter_ns() - st_t0) / 1e6)
+            return results
+
+        results = {'query': query, 'skipped': 0, 'total': 0}
+
         # do matching for each argumented collection
+        # with a top set, a min-heap holds the best matches so far, equal ratios going to the earliest string
         temp_results = []
-        for collection in collections:
-            # apply collection pre-processing settings to query
-            if self.__strlib[collection]['ignore_case']:
-                query = query.lower()
-            if self.__strlib[collection]['to_ascii']:
-                query = normalize("NFKD", query).encode("ascii", "ignore").decode()
-            if not self.__strlib[collection]['no_strip']:
-                query = query.strip()
-
-            results['total'] += self.__strlib[collection]['num_ref']
-
-            # do matching per word length
-            len_query = len(query)
-            for length, ref_list in self.__strlib[collection]['ref_by_len'].items():
-                # skip string set if its character length is smaller than lmin
-                if length < lmin:
-                    results['skipped'] += len(self.__strlib[collection]['ref_by_len'][length])
-                    continue
-
-                # skip string set if its character length is bigger than lmax
-                if lmax != 0:
-                    if length > lmax:
-                        results['skipped'] += len(self.__strlib[collection]['ref_by_len'][length])
-                        continue
-
-                # skip string set if its character length is out of look_around range
-                if look_around > -1:
-                    if abs(length - len_query) > look_around:
-                        results['skipped'] += len(self.__strlib[collection]['ref_by_len'][length])
+        cutoff = 0
+        col_queries = {}
+        for position, collection in enumerate(collections):
+            col = self.__strlib[collection]
+
+            # apply collection pre-processing settings to query, once for every distinct combination of settings
+            options = (col.ignore_case, col.to_ascii, col.no_strip)
+            col_query = col_queries.get(options)
+            if col_query is None:
+                col_query = query
+                if options[0]:
+                    col_query = col_query.lower()
+                if options[1] and not col_query.isascii():
+                    col_query = normalize("NFKD", col_query).encode("ascii", "ignore").decode()
+                if not options[2]:
+                    col_query = col_query.strip()
+                col_queries[options] = col_query
+
+            results['total'] += col.num_ref
+            results['skipped'] += col.num_ref
+
+            # only visit string sets within the lmin, lmax and look_around range, for a top most promising length first
+            len_query = len(col_query)
+            lo = lmin
+            hi = lmax if lmax != 0 else col.lengths[-1]
+            if look_around > -1:
+                lo = max(lo, len_query - look_around)
+                hi = min(hi, len_query + look_around)
+            if top is None:
+                lengths = [length for length in col.buckets if lo <= length <= hi]
+            else:
+                lengths = _nearest_lengths(col.lengths, lo, hi, len_query)
+            for length in lengths:
+                # stop when no string of this or any later length can still make the top
+                if len(temp_results) == top:
+                    bound = 200 * min(length, len_query) / (length + len_query)
+                    if bound < cutoff - 1e-9 or (bound <= cutoff and -temp_results[0][1] < position):
+                        break
+
+                ref_list, pre_list, val_list = col.buckets[length]
+                rank = col.ranks[length]
+                results['skipped'] -= len(ref_list)
+
+                # score the whole string set in one batched call, zeroing ratios below the cutoff
+                ratios = process.cdist([col_query], ref_list, scorer=fuzz.ratio, dtype=np.float64,
+                                       workers=-1 if len(ref_list) >= _PARALLEL_MIN else 1, score_cutoff=cutoff)[0]
+                if top is None:
+                    indices = np.argsort(-ratios, kind='stable')
+                else:
+                    # once the top is full only ratios from its lowest one up can still get in
+                    if len(temp_results) == top:
+                        indices = np.flatnonzero(ratios >= cutoff)
+                    else:
+                        indices = np.arange(len(ratios))
+                    if len(indices) > top:
+                        # keep every string tied at the lowest selected ratio, the sort puts the earliest first
+                        lowest = ratios[indices[np.argpartition(-ratios[indices], top - 1)[top - 1]]]
+                        indices = indices[ratios[indices] >= lowest]
+                    indices = indices[np.lexsort((indices, -ratios[indices]))][:top]
+
+                # convert the selection back to python numbers in one go rather than per numpy scalar
+                for i, ratio in zip(indices.tolist(), ratios[indices].tolist()):
+                    result = (pre_list[i], collection, ref_list[i], val_list[i] if val_list is not None else '', ratio)
+                    if top is None:
+                        temp_results.append(result)
                         continue
-
-                # get a list of ratios for this string set
-                ratios = process.extract(query, ref_list, scorer=fuzz.ratio, limit=top)
-
-                for ratio in ratios:
-                    result = (self.__strlib[collection]['col_by_len'][length][ratio[2]], collection, ratio[0],
-                              self.__strlib[collection]['val_by_len'][length][ratio[2]], ratio[1]),
-                    temp_results.extend(result)
+                    entry = (ratio, -position, -rank, -i, result)
+                    if len(temp_results) < top:
+                        heappush(temp_results, entry)
+                    elif entry > temp_results[0]:
+                        heapreplace(temp_results, entry)
+                    else:
+                        break
+                if top is not None and len(temp_results) == top:
+                    cutoff = temp_results[0][0]
 
         # finalize results and stats
-        temp_results.sort(key=lambda x: x[4], reverse=True)
-        if top != 0:
-            results['results'] = temp_results[:top]
-        else:
+        if top is None:
+            temp_results.sort(key=lambda x: x[4], reverse=True)
             results['results'] = temp_results
-        results['collections'] = collections
+        else:
+            temp_results.sort(reverse=True)
+            results['results'] = [entry[4] for entry in temp_results]
+        results['collections'] = collections.copy()
         results['tested'] = results['total'] - results['skipped']
         results['time'] = round((perf_counter_ns() - st_t0) / 1e6)
+
+        # all(!) results can be huge, so only limited tops are kept
+        if top is not None:
+            self.__cache[cache_key] = results.copy()
+            self.__cache[cache_key]['results'] = results['results'].copy()
+            self.__cache[cache_key]['collections'] = results['collections'].copy()
+            if len(self.__cache) > _CACHE_SIZE:
+                self.__cache.popitem(last=False)
         return results
 
 
+class _Collection:
+    """ Collection
+    Pre-processing settings and length-grouped strings of a single collection.
+    """
+    __slots__ = ('ignore_case', 'to_ascii', 'no_strip', 'num_ref', 'collection', 'values', 'buckets', 'lengths',
+                 'ranks')
+
+    def __init__(self, ignore_case: bool, to_ascii: bool, no_strip: bool):
+        self.ignore_case = ignore_case
+        self.to_ascii = to_ascii
+        self.no_strip = no_strip
+
+
+def _lower(strings: list[str]) -> list[str]:
+    """ Lowercase a list of strings, keeping each string that is already lowercase instead of an equal copy
+    :param strings: List of strings to lowercase.
+    :return: A new list with the lowercased strings.
+    """
+    return [string if (low := string.lower()) == string else low for string in strings]
+
+
+def _nearest_lengths(lengths: list[int], lo: int, hi: int, center: int):
+    """ Walk a sorted list of lengths outward from center, limited to lo <= length <= hi
+
+    Lengths come ordered by the best ratio a string of that length can reach against one of center length,
+    2 * min(center, length) / (center + length). A longer length goes first while center² >= shorter * longer.
+    So get_top can stop at the first length whose bound is below its cutoff. A bound equal to the cutoff only matters
+    within the collection of the lowest top entry, where a tie from an earlier string set wins. A small margin on
+    the comparison absorbs float rounding of the bound.
+
+    :param lengths: Ascending list of string lengths.
+    :param lo: Smallest length to yield.
+    :param hi: Biggest length to yield.
+    :param center: Length to start from.
+    :return: A generator yielding lengths from the highest to the lowest best possible ratio.
+    """
+    start = bisect_left(lengths, lo)
+    end = bisect_right(lengths, hi)
+    right = min(max(bisect_left(lengths, center), start), end)
+    left = right - 1
+    while left >= start or right < end:
+        if left < start or (right < end and center * center >= lengths[left] * lengths[right]):
+            yield lengths[right]
+            right += 1
+        else:
+            yield lengths[left]
+            left -= 1